@@ -2,137 +2,208 @@
 
 import json
 import click
+import multiprocessing
 import re
 import requests
 import structlog
-from voluptuous import Schema, Invalid, MultipleInvalid
-from collections import defaultdict
-from functools import reduce
-from operator import getitem
-from prometheus_client import CollectorRegistry, Gauge, write_to_textfile
+import sys
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
+from itertools import chain, zip_longest
+from multiprocessing.pool import ThreadPool
+from operator import itemgetter
+from prometheus_client import CollectorRegistry, write_to_textfile
+from prometheus_client.core import GaugeMetricFamily
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from urllib3.util.retry import Retry
+
+try:
+    import orjson as fastjson
+except ImportError:
+    # orjson only ships CPython builds, under PyPy the stdlib parser is jitted
+    fastjson = json
 
 
 log = structlog.get_logger()
 
-version_pattern = re.compile(r"^(?P<version>gluon-v\d{4}\.\d(?:\.\d)?(?:-\d+)?).*")
-base_pattern = re.compile(r"^(?P<base>gluon-v\d{4}\.\d(?:\.\d)?).*")
-seen = set()
-duplicates = 0
+# groups are version and base, firmware strings are ascii only
+version_pattern = re.compile(r"^((gluon-v\d{4}\.\d(?:\.\d)?)(?:-\d+)?)", re.ASCII)
 
+# mac addresses with their colons stripped
+mac_pattern = re.compile(r"[0-9a-fA-F]{12}", re.ASCII)
 
-# minimal schema definitions to recognize formats
-SCHEMA_MESHVIEWER = Schema({"timestamp": str, "nodes": [dict], "links": [dict]})
+# limit requests in flight per host, mirrors serving many urls would
+# otherwise get the whole pool at once
+HOST_SLOTS = 4
 
-SCHEMA_MESHVIEWER_OLD = Schema(
-    {"meta": {"timestamp": str}, "nodes": [dict], "links": [dict]}
+# share one session, so connections to hosts serving multiple urls are reused,
+# the adapter keeps a pool per host for all hosts in communities.json
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=128,
+    pool_maxsize=HOST_SLOTS,
+    max_retries=Retry(total=2, backoff_factor=0.3),
 )
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
 
-SCHEMA_NODESJSONV1 = Schema({"timestamp": str, "version": 1, "nodes": dict})
+_host_slots = {}
 
-SCHEMA_NODESJSONV2 = Schema({"timestamp": str, "version": 2, "nodes": [dict]})
 
+# both only see a handful of distinct strings across all communities
+@lru_cache(maxsize=None)
+def normalize_model_name(name):
+    return " ".join(name.split())
 
-def validate_macaddr(candidate):
-    blocks = candidate.split(":")
 
-    if len(blocks) != 6:
-        raise Invalid("Not a valid mac address")
+@lru_cache(maxsize=None)
+def match_version(firmware):
+    match = version_pattern.match(firmware)
+    if match:
+        return match.groups()
+    return None
 
-    try:
-        int("".join(blocks), 16)
-    except ValueError:
-        raise Invalid("Not a valid mac address")
 
-    return candidate
+# node ids are mostly mac addresses, stored as ints they take half the memory,
+# anything that is not exactly twelve hex digits is kept as it is
+def compact_node_id(node_id):
+    if not isinstance(node_id, str):
+        return node_id
+    digits = node_id.replace(":", "")
+    if not mac_pattern.fullmatch(digits):
+        return node_id
+    return int(digits, 16)
 
 
-def normalize_model_name(name):
-    return re.sub(r"\s+", " ", name)
+FORMATS = {}
 
 
-SCHEMA_ALFRED = Schema({validate_macaddr: dict})
+def register_hook(name, matches, parser):
+    FORMATS[name] = {"matches": matches, "parser": parser}
 
 
-FORMATS = {}
+# state of a run, owned by main() and only updated from its thread
+@dataclass(slots=True)
+class Census:
+    seen: set = field(default_factory=set)
+    duplicates: int = 0
+    version_totals: Counter = field(default_factory=Counter)
+    model_totals: Counter = field(default_factory=Counter)
 
 
-def register_hook(name, schema, parser):
-    FORMATS[name] = {"schema": schema, "parser": parser}
+# drop nodes seen in an earlier payload and add the rest straight to the
+# community's totals
+def count_nodes(census, community, unique, repeated):
+    known = unique.keys() & census.seen
+    for node_id in known:
+        del unique[node_id]
+    census.seen.update(unique)
+    census.duplicates += repeated + len(known)
+
+    # Counter tallies map() output without running bytecode per node
+    firmwares = Counter(map(itemgetter(1), unique.values()))
+    hardware = Counter(map(itemgetter(2), unique.values()))
+
+    # few distinct firmware and model strings per payload, so the regex and
+    # the normalization only run once for each of them
+    version_totals = census.version_totals
+    for firmware, count in firmwares.items():
+        key = match_version(firmware)
+        if key:
+            version, base = key
+            version_totals[community, base, version] += count
+    model_totals = census.model_totals
+    for model, count in hardware.items():
+        if model is not None:
+            model_totals[community, normalize_model_name(model)] += count
 
 
 def parse_meshviewer(data):
-    global seen, duplicates
-    bases = defaultdict(int)
-    models = defaultdict(int)
+    records = []
+    append = records.append
+    compact = compact_node_id
+    intern = sys.intern
     for node in data["nodes"]:
         try:
             node_id = node["node_id"]
-            if node_id in seen:
-                duplicates += 1
-                continue
             base = node["firmware"]["base"]
-            seen.add(node_id)
-            match = version_pattern.match(base)
-            if match:
-                bases[match.group("version")] += 1
-            model = normalize_model_name(node["model"])
-            models[model] += 1
         except KeyError as ex:
             continue
-    return bases, models
+        model = node.get("model")
+        if model is not None:
+            model = intern(model)
+        append((compact(node_id), intern(base), model))
+    return records
 
 
 def parse_nodes_json_v1(data, *kwargs):
-    global seen, duplicates
-    bases = defaultdict(int)
+    records = []
+    append = records.append
+    compact = compact_node_id
+    intern = sys.intern
     for node_id, node in data["nodes"].items():
-        if node_id in seen:
-            duplicates += 1
-            continue
         try:
             base = node["nodeinfo"]["software"]["firmware"]["base"]
         except KeyError as ex:
             continue
-        seen.add(node_id)
-        match = version_pattern.match(base)
-        if match:
-            bases[match.group("version")] += 1
-    return bases, dict()
+        append((compact(node_id), intern(base), None))
+    return records
 
 
 def parse_nodes_json_v2(data, *kwargs):
-    global seen, duplicates
-    bases = defaultdict(int)
-    models = defaultdict(int)
+    records = []
+    append = records.append
+    compact = compact_node_id
+    intern = sys.intern
     for node in data["nodes"]:
         try:
-            node_id = node["nodeinfo"]["node_id"]
-            if node_id in seen:
-                duplicates += 1
-                continue
-            base = node["nodeinfo"]["software"]["firmware"]["base"]
-            seen.add(node_id)
-            match = version_pattern.match(base)
-            if match:
-                bases[match.group("version")] += 1
-            model = normalize_model_name(node["nodeinfo"]["hardware"]["model"])
-            models[model] += 1
+            nodeinfo = node["nodeinfo"]
+            node_id = nodeinfo["node_id"]
+            base = nodeinfo["software"]["firmware"]["base"]
         except KeyError as ex:
             continue
+        model = nodeinfo.get("hardware", {}).get("model")
+        if model is not None:
+            model = intern(model)
+        append((compact(node_id), intern(base), model))
+    return records
+
 
-    return bases, models
+# minimal checks on top-level keys to recognize formats, never walk the nodes
+def match_meshviewer(data):
+    return "links" in data and "meta" not in data and isinstance(data["nodes"], list)
 
 
-register_hook("meshviewer", SCHEMA_MESHVIEWER, parse_meshviewer)
-register_hook("meshviewer (old)", SCHEMA_MESHVIEWER_OLD, parse_meshviewer)
-register_hook("nodes.json v1", SCHEMA_NODESJSONV1, parse_nodes_json_v1)
-register_hook("nodes.json v2", SCHEMA_NODESJSONV2, parse_nodes_json_v2)
-# register_hook('alfred', SCHEMA_ALFRED, parse_alfred)
+def match_meshviewer_old(data):
+    return "links" in data and "meta" in data and isinstance(data["nodes"], list)
+
+
+def match_nodes_json_v1(data):
+    return data.get("version") == 1 and isinstance(data["nodes"], dict)
+
+
+def match_nodes_json_v2(data):
+    return data.get("version") == 2 and isinstance(data["nodes"], list)
+
+
+register_hook("meshviewer", match_meshviewer, parse_meshviewer)
+register_hook("meshviewer (old)", match_meshviewer_old, parse_meshviewer)
+register_hook("nodes.json v1", match_nodes_json_v1, parse_nodes_json_v1)
+register_hook("nodes.json v2", match_nodes_json_v2, parse_nodes_json_v2)
 
 
 def download(url, timeout=5):
+    slots = _host_slots.setdefault(
+        urlparse(url).netloc, threading.BoundedSemaphore(HOST_SLOTS)
+    )
     try:
-        response = requests.get(url, timeout=timeout)
+        with slots:
+            response = SESSION.get(url, timeout=timeout)
     except requests.exceptions.RequestException as ex:
         log.msg("Exception caught while fetching url", ex=ex)
         raise ex
@@ -146,73 +217,148 @@ def download(url, timeout=5):
     return response
 
 
-def load(url):
+def detect_format(data):
+    if not isinstance(data, dict) or "nodes" not in data:
+        return None
+    for name, format in FORMATS.items():
+        if format["matches"](data):
+            return name
+    return None
+
+
+def parse(data):
+    name = detect_format(data)
+    if name is None:
+        raise ValueError("No parser found")
+
+    return name, FORMATS[name]["parser"](data)
+
+
+# runs in a worker process, only the compact node records are sent back
+def decode(content):
+    try:
+        data = fastjson.loads(content)
+    except fastjson.JSONDecodeError as ex:
+        # the exception holds the whole payload, send back only where it failed
+        raise ValueError(
+            f"{ex.msg}: line {ex.lineno} column {ex.colno} (char {ex.pos})"
+        ) from None
+    name, records = parse(data)
+
+    # keep only the first record for ids repeated within the payload
+    unique = {record[0]: record for record in reversed(records)}
+    return name, unique, len(records) - len(unique)
+
+
+def load(url, executor):
     response = download(url)
     if not response:
         raise ValueError("No response for HTTP request")
 
+    future = executor.submit(decode, response.content)
+    del response
     try:
-        data = response.json()
+        return future.result()
     except ValueError as ex:
         log.msg("Exception caught while processing url", url=url, ex=ex)
         raise ex
 
-    for name, format in FORMATS.items():
-        try:
-            format["schema"](data)
-            print(f"{name}\t{url}")
-            return format["parser"](data)
-        except (Invalid, MultipleInvalid) as ex:
-            pass
 
-    raise ValueError("No parser found")
+def named_load(executor, item):
+    index, community, url = item
+    try:
+        return index, community, url, load(url, executor)
+    except BrokenProcessPool:
+        # abort rather than write a partial census
+        log.msg("Decode worker died while processing url", url=url)
+        raise
+    except Exception:
+        return index, community, url, None
+
+
+# round-robin over hosts, so workers rarely wait on a busy host's slots, each
+# item keeps its position in communities.json to be counted in that order
+def interleave_hosts(communities):
+    hosts = defaultdict(list)
+    items = ((name, url) for name, urls in communities.items() for url in urls)
+    for index, (community, url) in enumerate(items):
+        hosts[urlparse(url).netloc].append((index, community, url))
+    return filter(None, chain.from_iterable(zip_longest(*hosts.values())))
+
+
+# hands the summed up totals to the registry in one go, instead of keeping
+# a child gauge object around for every single series
+class CensusCollector:
+    def __init__(self, census):
+        self.census = census
+
+    def collect(self):
+        metric_gluon_version_total = GaugeMetricFamily(
+            "gluon_base_total",
+            "Number of unique nodes running on a certain Gluon base version",
+            labels=["community", "base", "version"],
+        )
+        for labels, sum in self.census.version_totals.items():
+            metric_gluon_version_total.add_metric(labels, sum)
+        yield metric_gluon_version_total
+
+        metric_gluon_model_total = GaugeMetricFamily(
+            "gluon_model_total",
+            "Number of unique nodes using a certain device model",
+            labels=["community", "model"],
+        )
+        for labels, sum in self.census.model_totals.items():
+            metric_gluon_model_total.add_metric(labels, sum)
+        yield metric_gluon_model_total
 
 
 @click.command(short_help="Collect census information")
 @click.argument("outfile", default="./gluon-census.prom")
-def main(outfile):
-    registry = CollectorRegistry()
-    metric_gluon_version_total = Gauge(
-        "gluon_base_total",
-        "Number of unique nodes running on a certain Gluon base version",
-        ["community", "base", "version"],
-        registry=registry,
-    )
-    metric_gluon_model_total = Gauge(
-        "gluon_model_total",
-        "Number of unique nodes using a certain device model",
-        ["community", "model"],
-        registry=registry,
-    )
-
-    with open("./communities.json") as handle:
-        communities = json.load(handle)
-
-    for community, urls in communities.items():
-        for url in urls:
-            try:
-                versions, models = load(url)
-            except KeyboardInterrupt:
-                import sys
-
-                sys.exit(1)
-            except BaseException as ex:
-                continue
-            for version, sum in versions.items():
-                match = base_pattern.match(version)
-                base = match.group("base")
-                metric_gluon_version_total.labels(
-                    community=community, version=version, base=base
-                ).inc(sum)
-            for model, sum in models.items():
-                metric_gluon_model_total.labels(
-                    community=community, model=model
-                ).inc(sum)
+@click.option(
+    "--workers",
+    default=64,
+    type=click.IntRange(min=1),
+    show_default=True,
+    help="Number of urls to fetch concurrently",
+)
+def main(outfile, workers):
+    with open("./communities.json", "rb") as handle:
+        communities = fastjson.loads(handle.read())
+
+    fetchlist = interleave_hosts(communities)
+
+    census = Census()
+
+    # results are counted in communities.json order, so shared nodes are
+    # credited to the first community listing them
+    pending = {}
+    next_index = 0
+    with ProcessPoolExecutor(
+        mp_context=multiprocessing.get_context("spawn")
+    ) as executor, ThreadPool(workers) as pool:
+        results = pool.imap_unordered(partial(named_load, executor), fetchlist)
+        for index, community, url, result in results:
+            pending[index] = community, url, result
+            while next_index in pending:
+                community, url, result = pending.pop(next_index)
+                next_index += 1
+                if result is None:
+                    continue
+                name, unique, repeated = result
+                print(f"{name}\t{url}")
+                count_nodes(census, community, unique, repeated)
 
+    registry = CollectorRegistry()
+    registry.register(CensusCollector(census))
     write_to_textfile(outfile, registry)
 
-    print(len(seen), "unique nodes")
-    print(duplicates, "duplicates skipped")
+    print(len(census.seen), "unique nodes")
+    print(census.duplicates, "duplicates skipped")
+    log.msg(
+        "String cache statistics",
+        versions=match_version.cache_info(),
+        models=normalize_model_name.cache_info(),
+    )
 
 
 if __name__ == "__main__":
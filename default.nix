@@ -8,9 +8,9 @@ stdenv.mkDerivation {
     black
     click
     colorama
+    orjson
     prometheus_client
     requests
     structlog
-    voluptuous
   ];
 }